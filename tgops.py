@@ -1,8 +1,6 @@
 # /// script
 # dependencies = [
 #   "typer >=0.21, <1",
-#   "jinja2 >=3.1, <4",
-#   "structlog >=25, <26",
 # ]
 # ///
 """
@@ -14,18 +12,19 @@ streams output, and summarizes per-unit changes from plan logs.
 
 from __future__ import annotations
 
+import io
+import os
 import re
+import selectors
 import subprocess as sp
 import sys
 from collections import defaultdict
+from collections.abc import Iterator
 from dataclasses import dataclass
 from enum import Enum
 from pathlib import Path
-from threading import Thread
-from typing import IO, Annotated, TextIO
+from typing import Annotated, BinaryIO, TextIO
 
-import jinja2
-import structlog
 import typer
 
 # App setup
@@ -52,6 +51,14 @@ class StackDiffs:
     diffs: dict[str, list[str]]
 
 
+@dataclass
+class PlanLog:
+    """Tofu messages grouped by unit, plus the units that reported no changes, read from a plan log."""
+
+    entries: dict[str, list[str]]
+    stable: set[str]
+
+
 @dataclass
 class CommandResult:
     code: int
@@ -59,7 +66,33 @@ class CommandResult:
     stderr: str
 
 
-TOFU_RE = re.compile(r".*\[(?P<module>[^\]]+)\]\s+tofu:\s(?P<message>.*)")
+# Matched across whole chunks of a log, so no part of the pattern may cross a newline
+TOFU_RE = re.compile(
+    r"\[(?P<module>[^\]\n]+)\][^\S\n]+tofu:(?:[^\S\n]|$)(?P<message>.*)",
+    re.ASCII | re.MULTILINE,
+)
+NO_CHANGES_RE = re.compile(r"\s*no changes", re.IGNORECASE)
+
+EXIT_MARKER = "terragrunt-exit-code="
+EXIT_MARKER_RE = re.compile(rf"{EXIT_MARKER}(?P<code>\d*)")
+# The marker is the last line written to a plan log, so only the tail needs reading
+EXIT_MARKER_TAIL_SIZE = 512
+
+READ_SIZE = 1 << 16
+PARSE_CHUNK_SIZE = 1 << 20
+
+EXIT_CODE_STATES = {
+    "0": ChangeState.CLEAN,
+    "1": ChangeState.ERROR,
+    "2": ChangeState.DIRTY,
+}
+
+# tofu plan markers mapped to their fenced diff equivalents
+DIFF_MARKERS = {
+    "~": "!",
+    "+": "+",
+    "-": "-",
+}
 
 CLR = {
     "GREEN": "\033[0;32m",
@@ -69,154 +102,205 @@ CLR = {
 }
 
 GITHUB_PR_COMMENT_TMPL = """
-{% if state == 'NO_CHANGES' -%}
-No changes detected.
-{% elif state == 'HAS_ERROR' -%}
-Errors found. See logs.
-{% else -%}
-
 Unchanged units:
 
-{% if diffs and diffs.stable -%}
-{% for unit in diffs.stable -%}
-- `{{ unit }}`
-{% endfor -%}
-{% else -%}
-None
-{% endif %}
+{stable}
 
 
 Changed units:
 
-{% if diffs and diffs.diffs -%}
-{% for unit, lines in diffs.diffs.items() -%}
+{changed}
 
-- `{{ unit }}`
+"""
+
+GITHUB_PR_COMMENT_UNIT_TMPL = """- `{unit}`
 
 <details>
-<summary>Changes to {{ unit }}</summary>
+<summary>Changes to {unit}</summary>
 
 ```diff
-{% for ln in lines -%}
-{{ ln }}
-{% endfor -%}
-```
+{lines}```
 
 </details>
 
-{% endfor -%}
-{% else -%}
-None
-{% endif %}
-
-{% endif %}
 """
 
-LOGGER = structlog.get_logger(__name__)
-
 
 # Helpers
 
 def _normalize_diff_line(line: str) -> str:
     """Adjust diff markers to suit fenced diff blocks."""
     stripped = line.lstrip()
-    replace = {
-        "~": "!",
-        "+": "+",
-        "-": "-",
-    }
-    for k, v in replace.items():
-        if stripped.startswith(k):
-            return v + line.replace(stripped, stripped[1:], 1)
-    return line
-
-
-def _collect_unit_entries(log_file: Path) -> dict[str, list[str]]:
-    """Group tofu messages by unit from a plan log file."""
+    marker = DIFF_MARKERS.get(stripped[:1])
+    if marker is None:
+        return line
+    return marker + line[: len(line) - len(stripped)] + stripped[1:]
+
+
+def _read_line_chunks(fh: TextIO) -> Iterator[str]:
+    """Yield large chunks of a text file, each ending on a line boundary."""
+    tail = ""
+    while block := fh.read(PARSE_CHUNK_SIZE):
+        data = tail + block
+        cut = data.rfind("\n") + 1
+        tail = data[cut:]
+        yield data[:cut]
+    if tail:
+        yield tail
+
+
+def _collect_unit_entries(fh: TextIO) -> PlanLog:
+    """Group tofu messages by unit from a plan log, noting units that report no changes."""
     entries: dict[str, list[str]] = defaultdict(list)
-    with log_file.open("r", encoding="utf-8") as fh:
-        for ln in fh:
-            m = TOFU_RE.match(ln)
-            if not m:
-                continue
-            unit = m.group("module").replace(".terragrunt-stack/", "")
-            entries[unit].append(m.group("message"))
-    return entries
-
-
-def _summarize_unit_logs(log_file: Path) -> StackDiffs | None:
-    """Produce a unit-by-unit summary from a plan log file."""
-    if not log_file.exists():
-        LOGGER.warning("log file missing", path=str(log_file))
-        return None
-
-    grouped = _collect_unit_entries(log_file)
+    stable: set[str] = set()
+    units: dict[str, str] = {}  # raw module tag -> unit name, normalized once per tag
+    for chunk in _read_line_chunks(fh):
+        for module, msg in TOFU_RE.findall(chunk):
+            unit = units.get(module)
+            if unit is None:
+                unit = units[module] = module.replace(".terragrunt-stack/", "")
+            entries[unit].append(msg)
+            if unit not in stable and NO_CHANGES_RE.match(msg):
+                stable.add(unit)
+    return PlanLog(entries=entries, stable=stable)
+
+
+def _summarize_unit_logs(plan_log: PlanLog) -> StackDiffs:
+    """Produce a unit-by-unit summary from the tofu messages of a plan log."""
     stable: list[str] = []
     diffs: dict[str, list[str]] = {}
+    stable_units = plan_log.stable
+    normalize = _normalize_diff_line  # local lookup in the per-line comprehension
 
-    for unit, msgs in grouped.items():
-        if any(msg.strip().lower().startswith("no changes") for msg in msgs):
+    for unit, msgs in plan_log.entries.items():
+        if unit in stable_units:
             stable.append(unit)
         else:
-            diffs[unit] = [_normalize_diff_line(m) for m in msgs]
+            diffs[unit] = [normalize(m) for m in msgs]
 
     return StackDiffs(stable=stable, diffs=diffs)
 
 
+def _render_pr_comment(state: ChangeState, diffs: StackDiffs | None) -> str:
+    """Render the GitHub PR comment for a plan state and its per-unit diffs."""
+    if state == ChangeState.CLEAN:
+        return "\nNo changes detected.\n"
+    if state == ChangeState.ERROR:
+        return "\nErrors found. See logs.\n"
+
+    stable = "None\n"
+    if diffs and diffs.stable:
+        stable = "".join(f"- `{unit}`\n" for unit in diffs.stable)
+
+    changed = "None\n"
+    if diffs and diffs.diffs:
+        changed = "".join(
+            GITHUB_PR_COMMENT_UNIT_TMPL.format(unit=unit, lines="".join(f"{ln}\n" for ln in lines))
+            for unit, lines in diffs.diffs.items()
+        )
+
+    return GITHUB_PR_COMMENT_TMPL.format(stable=stable, changed=changed)
+
+
+def _read_exit_code(fh: BinaryIO) -> str | None:
+    """Find the exit code marker at the end of a plan log without reading the rest of it."""
+    size = fh.seek(0, os.SEEK_END)
+    fh.seek(max(size - EXIT_MARKER_TAIL_SIZE, 0))
+    codes = EXIT_MARKER_RE.findall(fh.read().decode("utf-8", errors="replace"))
+    return codes[-1] if codes else None
+
+
 def _write_exit_marker(path: Path, code: int) -> None:
     with path.open("a", encoding="utf-8") as fh:
-        fh.write(f"terragrunt-exit-code={code}\n")
+        fh.write(f"{EXIT_MARKER}{code}\n")
 
 
 def run_live(
-    cmd: list[str], *, log_file: Path | None = None, cwd: Path | None = None, quiet: bool = False
+    cmd: list[str],
+    *,
+    log_file: Path | None = None,
+    cwd: Path | None = None,
+    quiet: bool = False,
+    capture: bool = False,
 ) -> CommandResult:
-    """Execute a command, stream output, optionally tee to a log file."""
+    """Execute a command, stream output, optionally tee to a log file and capture it.
+
+    POSIX only: the output pipes are multiplexed with `selectors`, which on
+    Windows only supports sockets.
+    """
+    if log_file and quiet and not capture:
+        # Nothing is echoed or kept, so the child can write straight into the log
+        log_file.parent.mkdir(parents=True, exist_ok=True)
+        with log_file.open("ab") as sink:
+            code = sp.call(cmd, stdout=sink, stderr=sp.STDOUT, cwd=cwd)  # noqa: S603
+        return CommandResult(code=code, stdout="", stderr="")
+
+    # Pipes are read with os.read in READ_SIZE chunks, so skip Python-level buffering
     proc = sp.Popen(  # noqa: S603
         cmd,
         stdout=sp.PIPE,
         stderr=sp.PIPE,
-        text=True,
-        bufsize=1,
-        cwd=str(cwd) if cwd else None,
+        bufsize=0,
+        cwd=cwd,
     )
+    out_pipe, err_pipe = proc.stdout, proc.stderr
+    assert out_pipe is not None and err_pipe is not None  # noqa: S101
 
-    out_lines: list[str] = []
-    err_lines: list[str] = []
+    out_buf = io.BytesIO() if capture else None
+    err_buf = io.BytesIO() if capture else None
 
+    log_fh: BinaryIO | None = None
     if log_file:
         log_file.parent.mkdir(parents=True, exist_ok=True)
-        log_file.touch()
-        log_fh = log_file.open("a", encoding="utf-8")
-    else:
-        log_fh = None
-
-    def _drain(pipe: IO[str], collector: list[str], target: TextIO) -> None:
-        try:
-            for ln in iter(pipe.readline, ""):
-                collector.append(ln)
-                if not quiet:
-                    target.write(ln)
-                    target.flush()
-                if log_fh is not None:
-                    log_fh.write(ln)
-                    log_fh.flush()
-        finally:
-            pipe.close()
-
-    t_out = Thread(target=_drain, args=(proc.stdout, out_lines, sys.stdout), daemon=True)
-    t_err = Thread(target=_drain, args=(proc.stderr, err_lines, sys.stderr), daemon=True)
-    t_out.start()
-    t_err.start()
+        # Buffer a full read's worth so small bursts of lines coalesce into one write
+        log_fh = log_file.open("ab", buffering=READ_SIZE)
+
+    def _emit(data: bytes | bytearray, collector: io.BytesIO | None, target: TextIO) -> None:
+        if collector is not None:
+            collector.write(data)
+        if not quiet:
+            target.write(data.decode("utf-8", errors="replace"))
+        if log_fh is not None:
+            log_fh.write(data)
+
+    # Read both pipes from one thread; only complete lines are forwarded so
+    # stdout and stderr never interleave mid-line in the console or log.
+    with selectors.DefaultSelector() as sel:
+        sel.register(out_pipe, selectors.EVENT_READ, (out_pipe, bytearray(), out_buf, sys.stdout))
+        sel.register(err_pipe, selectors.EVENT_READ, (err_pipe, bytearray(), err_buf, sys.stderr))
+        while sel.get_map():
+            for key, _ in sel.select():
+                pipe, pending, collector, target = key.data
+                chunk = os.read(key.fd, READ_SIZE)
+                if not chunk:
+                    sel.unregister(pipe)
+                    pipe.close()
+                    if pending:
+                        _emit(pending, collector, target)
+                    continue
+                pending += chunk
+                end = pending.rfind(b"\n") + 1
+                if end:
+                    _emit(pending[:end], collector, target)
+                    del pending[:end]
+            # Flush once per wake-up rather than per line: output still streams (and
+            # stays ordered against stderr) in CI, where stdout is block-buffered.
+            if not quiet:
+                sys.stdout.flush()
+                sys.stderr.flush()
     proc.wait()
-    t_out.join()
-    t_err.join()
 
     if log_fh is not None:
         log_fh.flush()
         log_fh.close()
 
-    return CommandResult(code=proc.returncode, stdout="".join(out_lines), stderr="".join(err_lines))
+    if out_buf is None or err_buf is None:
+        return CommandResult(code=proc.returncode, stdout="", stderr="")
+    return CommandResult(
+        code=proc.returncode,
+        stdout=out_buf.getvalue().decode("utf-8", errors="replace"),
+        stderr=err_buf.getvalue().decode("utf-8", errors="replace"),
+    )
 
 
 # Commands
@@ -238,43 +322,40 @@ def plan_github_pr_comment(
     ],
 ) -> None:
     """Parse a plan log and render a summary to post to a GitHub PR comment."""
-    if not log_file.exists():
-        raise typer.BadParameter(f"Log file not found: {log_file}")
-
-    content = log_file.read_text()
-    if "terragrunt-exit-code=" not in content:
-        raise typer.BadParameter("Log file missing terragrunt-exit-code marker")
-
-    if "terragrunt-exit-code=0" in content:
-        state = "NO_CHANGES"
-    elif "terragrunt-exit-code=1" in content:
-        state = "HAS_ERROR"
-    elif "terragrunt-exit-code=2" in content:
-        state = "HAS_CHANGES"
-    else:
-        raise typer.BadParameter("Unexpected exit code marker in log file")
-
-    diffs = _summarize_unit_logs(log_file)
-    template = jinja2.Template(GITHUB_PR_COMMENT_TMPL)
-    rendered = template.render(
-        state=state,
-        diffs=diffs,
-    )
-    output.write_text(rendered)
+    try:
+        fh = log_file.open("rb")
+    except FileNotFoundError:
+        raise typer.BadParameter(f"Log file not found: {log_file}") from None
+    with fh:
+        exit_code = _read_exit_code(fh)
+        if exit_code is None:
+            raise typer.BadParameter("Log file missing terragrunt-exit-code marker")
+
+        state = EXIT_CODE_STATES.get(exit_code)
+        if state is None:
+            raise typer.BadParameter("Unexpected exit code marker in log file")
+
+        # Only a plan with changes lists units, so skip the full scan otherwise
+        diffs = None
+        if state == ChangeState.DIRTY:
+            fh.seek(0)
+            with io.TextIOWrapper(fh, encoding="utf-8") as text:
+                diffs = _summarize_unit_logs(_collect_unit_entries(text))
+    output.write_text(_render_pr_comment(state, diffs))
     typer.echo(f"Wrote GitHub PR comment format to {output}")
 
 
 class Runner:
     def __init__(self, stack_root: Path) -> None:
         self.stack_root = stack_root
+        self.tg_cmd = ["terragrunt", f"--working-dir={stack_root!s}"]
 
     def plan(self, *, log_file: Path | None = None) -> ChangeState:
-        if log_file and log_file.exists():
-            log_file.unlink()
+        if log_file:
+            log_file.unlink(missing_ok=True)
 
         plan_cmd = [
-            "terragrunt",
-            f"--working-dir={self.stack_root!s}",
+            *self.tg_cmd,
             "stack",
             "run",
             "--",
@@ -283,13 +364,13 @@ class Runner:
             "-out=tofu.plan",
         ]
 
-        result = run_live(plan_cmd, log_file=log_file)
+        # stderr is only replayed on failure when there is no log file to point at
+        result = run_live(plan_cmd, log_file=log_file, capture=not log_file)
 
         if log_file and result.code != 1:
             show_cmd = [
-                "terragrunt",
+                *self.tg_cmd,
                 "--no-color",
-                f"--working-dir={self.stack_root!s}",
                 "stack",
                 "run",
                 "--",
@@ -313,11 +394,9 @@ class Runner:
         raise typer.Exit(code=1)
 
     def apply(self, *, non_interactive: bool = False) -> None:
-        tg_args = [f"--working-dir={self.stack_root!s}"]
-        if non_interactive:
-            tg_args.extend(["--non-interactive"])
+        tg_args = ["--non-interactive"] if non_interactive else []
         cmd = [
-            "terragrunt",
+            *self.tg_cmd,
             *tg_args,
             "stack",
             "run",